@@ -52,10 +52,16 @@ def run_centralized(optimizer: tf.keras.optimizers.Optimizer,
       that many batches. If set to None or a nonpositive integer, the full
       datasets are used.
   """
+  limit_batches = max_batches is not None and max_batches >= 1
+  # Datasets that are only partially read are not cached in memory, since an
+  # incomplete in-memory cache is discarded.
   train_dataset, eval_dataset = emnist_dataset.get_centralized_datasets(
-      train_batch_size=batch_size, only_digits=False, emnist_task='autoencoder')
+      train_batch_size=batch_size,
+      only_digits=False,
+      emnist_task='autoencoder',
+      cache_dataset=not limit_batches)
 
-  if max_batches and max_batches >= 1:
+  if limit_batches:
     train_dataset = train_dataset.take(max_batches)
     eval_dataset = eval_dataset.take(max_batches)
 
@@ -14,7 +14,9 @@
 """Library for loading and preprocessing EMNIST training and testing data."""
 
 import collections
-from typing import List, Optional, Tuple
+import functools
+import os
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
@@ -22,36 +24,133 @@ import tensorflow_federated as tff
 
 MAX_CLIENT_DATASET_SIZE = 418
 NUM_CLIENTS_P13N_TRAIN = 2500
+CACHE_BATCH_SIZE = 64
+
+
+def _quantize_pixels(element):
+  """Converts `tf.float32` pixels to `tf.uint8` values.
+
+  This conversion is lossy: pixels are clipped to [0, 1] and then rounded to
+  the nearest multiple of 1/255. EMNIST pixels already lie on this grid, so they
+  are preserved. Pixels that are already `tf.uint8` are returned unchanged.
+
+  Args:
+    element: A mapping with 'label' and 'pixels' keys, possibly batched.
+
+  Returns:
+    An `collections.OrderedDict` with the same keys, and `tf.uint8` pixels.
+  """
+  pixels = element['pixels']
+  if pixels.dtype != tf.uint8:
+    pixels = tf.clip_by_value(pixels, 0.0, 1.0)
+    pixels = tf.cast(tf.round(pixels * 255.0), tf.uint8)
+  return collections.OrderedDict(label=element['label'], pixels=pixels)
+
+
+def _convert_pixels_to_float(pixels):
+  """Converts pixels to `tf.float32` values in [0, 1]."""
+  if pixels.dtype == tf.uint8:
+    return tf.cast(pixels, tf.float32) * (1.0 / 255.0)
+  return pixels
 
 
 def _reshape_for_digit_recognition(element):
-  return (tf.expand_dims(element['pixels'], axis=-1), element['label'])
+  pixels = tf.expand_dims(element['pixels'], axis=-1)
+  return (_convert_pixels_to_float(pixels), element['label'])
 
 
 def _reshape_for_autoencoder(element):
-  x = 1 - tf.reshape(element['pixels'], (-1, 28 * 28))
+  # The inputs and targets are the same tensor, so the pixels are converted to
+  # `tf.float32` once and no copy of the targets is materialized.
+  pixels = tf.reshape(element['pixels'], (-1, 28 * 28))
+  x = 1.0 - _convert_pixels_to_float(pixels)
   return (x, x)
 
 
+def _get_dataset_options() -> tf.data.Options:
+  """Returns the `tf.data.Options` applied to preprocessed EMNIST datasets."""
+  options = tf.data.Options()
+  # These options target TF 2.6 and later, where buffer autotuning is part of
+  # `tf.data.Options.autotune`, rather than of `experimental_optimization`.
+  options.autotune.enabled = True
+  options.experimental_optimization.apply_default_optimizations = True
+  options.experimental_optimization.map_and_batch_fusion = True
+  options.experimental_optimization.noop_elimination = True
+  return options
+
+
+def _shuffle_and_repeat_in_memory(dataset: tf.data.Dataset,
+                                  num_epochs: int) -> tf.data.Dataset:
+  """Shuffles and repeats a dataset by materializing it as tensors.
+
+  Each epoch is an independent, uniformly random permutation of the entire
+  dataset. This matches `tf.data.Dataset.shuffle` with a buffer at least as
+  large as the dataset, without the cost of refilling a shuffle buffer. This
+  should only be used for small datasets, such as a single client's data.
+
+  While materialized, the pixels are held as `tf.uint8` values (see
+  `_quantize_pixels`), converted in a single vectorized op.
+
+  Args:
+    dataset: A `tf.data.Dataset` of EMNIST elements.
+    num_epochs: An integer representing the number of epochs to repeat the
+      dataset. If set to -1, the dataset is repeated indefinitely.
+
+  Returns:
+    A `tf.data.Dataset` with the same keys as `dataset`, with `tf.uint8`
+    pixels.
+  """
+  # Batching without `drop_remainder` only reserves memory for a bounded number
+  # of elements, so this yields a single batch holding the entire dataset, or
+  # no batch at all if the dataset is empty.
+  materialized_dataset = dataset.batch(tf.int64.max).map(_quantize_pixels)
+
+  def permute_elements(elements):
+    num_elements = tf.shape(elements['pixels'])[0]
+    indices = tf.random.shuffle(tf.range(num_elements))
+    return tf.data.Dataset.from_tensor_slices(
+        tf.nest.map_structure(lambda t: tf.gather(t, indices), elements))
+
+  # The batch is repeated within `flat_map`, so the underlying dataset is only
+  # read once. Unlike `tf.data.Dataset.cache`, this does not require the
+  # epochs to be read in full, as when they are limited by `max_batches`.
+  def shuffle_and_repeat(elements):
+    return tf.data.Dataset.from_tensors(elements).repeat(num_epochs).flat_map(
+        permute_elements)
+
+  return materialized_dataset.flat_map(shuffle_and_repeat)
+
+
 def create_preprocess_fn(
     num_epochs: int,
     batch_size: int,
     max_batches: int = -1,
     shuffle_buffer_size: int = MAX_CLIENT_DATASET_SIZE,
     emnist_task: str = 'digit_recognition',
-    num_parallel_calls: tf.Tensor = tf.data.experimental.AUTOTUNE
+    num_parallel_calls: tf.Tensor = tf.data.experimental.AUTOTUNE,
+    cache_dataset: bool = False,
+    in_memory_shuffle: bool = False
 ) -> tff.Computation:
   """Creates a preprocessing function for EMNIST client datasets.
 
-  The preprocessing shuffles, repeats, batches, and then reshapes, using
-  the `shuffle`, `repeat`, `batch`, and `map` attributes of a
-  `tf.data.Dataset`, in that order.
+  The preprocessing shuffles, repeats, batches, reshapes, and then prefetches,
+  using the `shuffle`, `repeat`, `batch`, `map`, and `prefetch` attributes of a
+  `tf.data.Dataset`, in that order. Prefetching is applied last so that the
+  prefetch buffer holds whole batches. The reshaping is applied to batched
+  elements, so that it is performed once per batch rather than once per example.
+  Transformations that would have no effect (such as shuffling with a buffer
+  size of 1, or repeating for a single epoch) are omitted.
+
+  If the dataset is cached or shuffled in memory, pixels are quantized to
+  `tf.uint8` while held in memory, so that they take 4x less space. They are
+  converted back to `tf.float32` when reshaping.
 
   Args:
     num_epochs: An integer representing the number of epochs to repeat the
       client datasets.
     batch_size: An integer representing the batch size on clients.
     max_batches: An integer representing the limit on the number of batches.
+      If set to a negative number, no limit is applied.
     shuffle_buffer_size: An integer representing the shuffle buffer size on
       clients. If set to a number <= 1, no shuffling occurs.
     emnist_task: A string indicating the EMNIST task being performed. Must be
@@ -60,15 +159,30 @@ def create_preprocess_fn(
       elements are mapped to tuples of the form (pixels, pixels).
     num_parallel_calls: An integer representing the number of parallel calls
       used when performing `tf.data.Dataset.map`.
+    cache_dataset: A boolean indicating whether to cache the input dataset in
+      memory (via `tf.data.Dataset.cache`) before shuffling. This avoids
+      re-reading the underlying data on every epoch, at the cost of holding the
+      entire dataset in memory. If True, pixels are quantized before caching,
+      which clips them to [0, 1] and rounds them to the nearest multiple of
+      1/255.
+    in_memory_shuffle: A boolean indicating whether the datasets may be
+      shuffled by materializing them in memory. If True and
+      `shuffle_buffer_size` is at least `MAX_CLIENT_DATASET_SIZE`, each epoch
+      is a uniformly random permutation of the entire dataset, rather than
+      being shuffled via a shuffle buffer. This should only be set for small
+      datasets, such as a single client's data. Pixels shuffled in memory are
+      quantized as for `cache_dataset`.
 
   Returns:
-    A `tff.Computation` performing the preprocessing discussed above.
+    A `tff.Computation` performing the preprocessing discussed above. Its input
+    pixels are expected to be `tf.float32` values in [0, 1] on a grid of 1/255
+    (as in EMNIST). Other pixel values are altered when the pixels are
+    quantized, see `cache_dataset` and `in_memory_shuffle`.
   """
   if num_epochs < 0 and max_batches < 0:
     raise ValueError(f'Either num_epochs ({num_epochs}) or max_batches '
                      f'({max_batches}) must be a positive integer.')
-  if shuffle_buffer_size <= 1:
-    shuffle_buffer_size = 1
+  shuffle = shuffle_buffer_size > 1
 
   if emnist_task == 'digit_recognition':
     mapping_fn = _reshape_for_digit_recognition
@@ -78,6 +192,15 @@ def create_preprocess_fn(
     raise ValueError('emnist_task must be one of "digit_recognition" or '
                      '"autoencoder".')
 
+  # A shuffle buffer of `MAX_CLIENT_DATASET_SIZE` elements holds any federated
+  # training client dataset in full, so shuffling such a dataset in memory has
+  # the same effect. p13n training datasets concatenate a client's train and
+  # test data and may be larger, in which case shuffling in memory is more
+  # thorough than the shuffle buffer it replaces. Either way, it avoids the
+  # overhead of filling a shuffle buffer.
+  shuffle_in_memory = (
+      in_memory_shuffle and shuffle_buffer_size >= MAX_CLIENT_DATASET_SIZE)
+
   # Features are intentionally sorted lexicographically by key for consistency
   # across datasets.
   feature_dtypes = collections.OrderedDict(
@@ -86,13 +209,96 @@ def create_preprocess_fn(
 
   @tff.tf_computation(tff.SequenceType(feature_dtypes))
   def preprocess_fn(dataset):
-    return dataset.shuffle(shuffle_buffer_size).repeat(num_epochs).batch(
-        batch_size, drop_remainder=False).take(max_batches).map(
-            mapping_fn, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.with_options(_get_dataset_options())
+    if cache_dataset:
+      # This per-example map only runs while the cache is being filled.
+      dataset = dataset.map(
+          _quantize_pixels, num_parallel_calls=num_parallel_calls).cache()
+    if shuffle_in_memory:
+      dataset = _shuffle_and_repeat_in_memory(dataset, num_epochs)
+    else:
+      if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer_size)
+      if num_epochs != 1:
+        dataset = dataset.repeat(num_epochs)
+    dataset = dataset.batch(batch_size, drop_remainder=False)
+    if max_batches >= 0:
+      dataset = dataset.take(max_batches)
+    return dataset.map(
+        mapping_fn, num_parallel_calls=num_parallel_calls).prefetch(
+            tf.data.experimental.AUTOTUNE)
 
   return preprocess_fn
 
 
+@functools.lru_cache(maxsize=2)
+def _load_emnist_data(
+    only_digits: bool
+) -> Tuple[tff.simulation.datasets.ClientData,
+           tff.simulation.datasets.ClientData]:
+  """Loads the federated EMNIST training and testing sets.
+
+  The results are memoized, so that the public functions in this module share
+  the same `tff.simulation.datasets.ClientData` objects. Note that this holds
+  references to the loaded data until the process exits.
+
+  Args:
+    only_digits: A boolean representing whether to load EMNIST-10 or EMNIST-62.
+
+  Returns:
+    A tuple (emnist_train, emnist_test) of `tff.simulation.datasets.ClientData`.
+  """
+  return tff.simulation.datasets.emnist.load_data(only_digits=only_digits)
+
+
+def _create_tf_dataset_from_all_clients(
+    client_data: tff.simulation.datasets.ClientData) -> tf.data.Dataset:
+  """Creates a dataset over all clients, reading client datasets in parallel.
+
+  Unlike `create_tf_dataset_from_all_clients` of a
+  `tff.simulation.datasets.ClientData`, which reads client datasets
+  sequentially, this interleaves the client datasets with parallel reads. The
+  order of examples is not deterministic.
+
+  Args:
+    client_data: A `tff.simulation.datasets.ClientData`.
+
+  Returns:
+    A `tf.data.Dataset` containing the examples of all clients.
+  """
+  client_ids = tf.data.Dataset.from_tensor_slices(client_data.client_ids)
+  return client_ids.interleave(
+      client_data.serializable_dataset_fn,
+      cycle_length=tf.data.experimental.AUTOTUNE,
+      num_parallel_calls=tf.data.experimental.AUTOTUNE,
+      deterministic=False)
+
+
+def _get_cache_dir(cache_dir: str, only_digits: bool) -> str:
+  """Creates and returns the directory used to cache EMNIST data on disk."""
+  dataset_name = 'emnist_digits' if only_digits else 'emnist_all'
+  path = os.path.join(cache_dir, dataset_name)
+  tf.io.gfile.makedirs(path)
+  return path
+
+
+def _cache_to_file(dataset: tf.data.Dataset,
+                   filename: Union[str, tf.Tensor]) -> tf.data.Dataset:
+  """Caches a dataset to a file, storing its examples in batches.
+
+  Each cache entry holds up to `CACHE_BATCH_SIZE` examples, which reduces the
+  number of entries read from the cache per example.
+
+  Args:
+    dataset: A `tf.data.Dataset` of EMNIST examples.
+    filename: A path to the file used to cache the dataset.
+
+  Returns:
+    A `tf.data.Dataset` with the same element structure as `dataset`.
+  """
+  return dataset.batch(CACHE_BATCH_SIZE).cache(filename).unbatch()
+
+
 def get_federated_datasets(
     train_client_batch_size: int = 20,
     test_client_batch_size: int = 100,
@@ -141,25 +347,22 @@ def get_federated_datasets(
         'train_client_epochs_per_round must be a positive integer.')
   if test_client_epochs_per_round < 0:
     raise ValueError('test_client_epochs_per_round must be a positive integer.')
-  if train_shuffle_buffer_size <= 1:
-    train_shuffle_buffer_size = 1
-  if test_shuffle_buffer_size <= 1:
-    test_shuffle_buffer_size = 1
 
-  emnist_train, emnist_test = tff.simulation.datasets.emnist.load_data(
-      only_digits=only_digits)
+  emnist_train, emnist_test = _load_emnist_data(only_digits)
 
   train_preprocess_fn = create_preprocess_fn(
       num_epochs=train_client_epochs_per_round,
       batch_size=train_client_batch_size,
       shuffle_buffer_size=train_shuffle_buffer_size,
-      emnist_task=emnist_task)
+      emnist_task=emnist_task,
+      in_memory_shuffle=True)
 
   test_preprocess_fn = create_preprocess_fn(
       num_epochs=test_client_epochs_per_round,
       batch_size=test_client_batch_size,
       shuffle_buffer_size=test_shuffle_buffer_size,
-      emnist_task=emnist_task)
+      emnist_task=emnist_task,
+      in_memory_shuffle=True)
 
   emnist_train = emnist_train.preprocess(train_preprocess_fn)
   emnist_test = emnist_test.preprocess(test_preprocess_fn)
@@ -172,7 +375,10 @@ def get_centralized_datasets(
     train_shuffle_buffer_size: int = 10000,
     test_shuffle_buffer_size: int = 1,
     only_digits: bool = False,
-    emnist_task: str = 'digit_recognition'
+    emnist_task: str = 'digit_recognition',
+    cache_dataset: bool = True,
+    cache_dir: Optional[str] = None,
+    device: Optional[str] = None
 ) -> Tuple[tf.data.Dataset, tf.data.Dataset]:
   """Loads and preprocesses centralized EMNIST training and testing sets.
 
@@ -193,37 +399,59 @@ def get_centralized_datasets(
       one of 'digit_recognition' or 'autoencoder'. If the former, then elements
       are mapped to tuples of the form (pixels, label), if the latter then
       elements are mapped to tuples of the form (pixels, pixels).
+    cache_dataset: A boolean indicating whether to cache the datasets over all
+      clients in memory, so that later epochs do not re-read the client data.
+      An in-memory cache is only kept once the dataset is read in full, so this
+      should be set to False if the datasets are read partially (for example,
+      via `tf.data.Dataset.take`), as they are then re-read on every epoch.
+    cache_dir: An optional directory used to cache the datasets over all
+      clients on disk (via `tf.data.Dataset.cache`), so that later runs do not
+      re-read the client data. This is independent of the in-memory caching
+      and shuffling of the datasets. If set to None, no on-disk caching occurs.
+    device: An optional string specifying a device (such as '/GPU:0') to which
+      batches are prefetched, via `tf.data.experimental.prefetch_to_device`.
+      This overlaps host-to-device copies with training steps. If set to None,
+      the datasets remain on the host.
 
   Returns:
     A tuple (train_dataset, test_dataset) of `tf.data.Dataset` instances
     representing the centralized training and test datasets.
   """
-  if train_shuffle_buffer_size <= 1:
-    train_shuffle_buffer_size = 1
-  if test_shuffle_buffer_size <= 1:
-    test_shuffle_buffer_size = 1
+  emnist_train, emnist_test = _load_emnist_data(only_digits)
 
-  emnist_train, emnist_test = tff.simulation.datasets.emnist.load_data(
-      only_digits=only_digits)
+  emnist_train = _create_tf_dataset_from_all_clients(emnist_train)
+  emnist_test = _create_tf_dataset_from_all_clients(emnist_test)
 
-  emnist_train = emnist_train.create_tf_dataset_from_all_clients()
-  emnist_test = emnist_test.create_tf_dataset_from_all_clients()
+  if cache_dir is not None:
+    cache_dir = _get_cache_dir(cache_dir, only_digits)
+    emnist_train = _cache_to_file(emnist_train,
+                                  os.path.join(cache_dir, 'train'))
+    emnist_test = _cache_to_file(emnist_test, os.path.join(cache_dir, 'test'))
 
   train_preprocess_fn = create_preprocess_fn(
       num_epochs=1,
       batch_size=train_batch_size,
       shuffle_buffer_size=train_shuffle_buffer_size,
-      emnist_task=emnist_task)
+      emnist_task=emnist_task,
+      cache_dataset=cache_dataset)
 
   test_preprocess_fn = create_preprocess_fn(
       num_epochs=1,
       batch_size=test_batch_size,
       shuffle_buffer_size=test_shuffle_buffer_size,
-      emnist_task=emnist_task)
+      emnist_task=emnist_task,
+      cache_dataset=cache_dataset)
 
   emnist_train = train_preprocess_fn(emnist_train)
   emnist_test = test_preprocess_fn(emnist_test)
 
+  if device is not None:
+    # Prefetching to a device must be the final transformation of a dataset.
+    emnist_train = emnist_train.apply(
+        tf.data.experimental.prefetch_to_device(device, buffer_size=2))
+    emnist_test = emnist_test.apply(
+        tf.data.experimental.prefetch_to_device(device, buffer_size=2))
+
   return emnist_train, emnist_test
 
 
@@ -237,7 +465,9 @@ def get_federated_p13n_datasets(
     only_digits: bool = False,
     emnist_task: str = 'digit_recognition',
     shuffle_buffer_size: int = MAX_CLIENT_DATASET_SIZE,
-    seed: Optional[int] = None
+    seed: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    num_parallel_calls: Optional[int] = None
 ) -> Tuple[List[str], List[str], tff.Computation, tff.Computation]:
   """Loads and preprocesses federated EMNIST p13n training and testing sets.
 
@@ -264,23 +494,37 @@ def get_federated_p13n_datasets(
       to some integer less than or equal to 1, no shuffling occurs.
     seed: An optional integer for seeding random splitting of the clients into
       training and test sets.
+    cache_dir: An optional directory used to cache each training client's
+      concatenated train and test data on disk (via `tf.data.Dataset.cache`).
+      A client's cache is only written once its dataset is read in full. If set
+      to None, no caching occurs.
+    num_parallel_calls: An optional integer representing the number of parallel
+      calls used when performing `tf.data.Dataset.map` on each client dataset.
+      Since many client datasets are processed concurrently, this defaults to
+      the number of CPUs capped at 16, rather than to
+      `tf.data.experimental.AUTOTUNE`.
 
   Returns:
     A dict that contains train and test client ids, dataset computation used
     for federated training and a list of test client datasets.
   """
 
-  emnist_train, emnist_test = tff.simulation.datasets.emnist.load_data(
-    only_digits=only_digits)
+  emnist_train, emnist_test = _load_emnist_data(only_digits)
   client_ids = emnist_train.client_ids
-  assert set(client_ids) == set(emnist_test.client_ids)
+  # Client ids are returned in sorted order, so they can be compared directly.
+  assert list(client_ids) == list(emnist_test.client_ids)
+
+  if num_parallel_calls is None:
+    num_parallel_calls = min(16, os.cpu_count() or 1)
 
   train_preprocess_fn = create_preprocess_fn(
     num_epochs=train_epochs,
     max_batches=train_max_batches,
     batch_size=train_batch_size,
     shuffle_buffer_size=shuffle_buffer_size,
-    emnist_task=emnist_task)
+    emnist_task=emnist_task,
+    num_parallel_calls=num_parallel_calls,
+    in_memory_shuffle=True)
 
   eval_inner_preprocess_fn = create_preprocess_fn(
     num_epochs=eval_inner_epochs,
@@ -288,17 +532,25 @@ def get_federated_p13n_datasets(
     batch_size=eval_batch_size,
     # Note: we still need to shuffle data for fine-tuning at eval time.
     shuffle_buffer_size=shuffle_buffer_size,
-    emnist_task=emnist_task)
+    emnist_task=emnist_task,
+    num_parallel_calls=num_parallel_calls,
+    in_memory_shuffle=True)
 
   eval_outer_preprocess_fn = create_preprocess_fn(
     num_epochs=1,  # One epoch is always sufficient for eval.
     batch_size=eval_batch_size,
     shuffle_buffer_size=1,
-    emnist_task=emnist_task)
+    emnist_task=emnist_task,
+    num_parallel_calls=num_parallel_calls)
+
+  if cache_dir is not None:
+    p13n_cache_dir = os.path.join(
+        _get_cache_dir(cache_dir, only_digits), 'p13n')
+    tf.io.gfile.makedirs(p13n_cache_dir)
 
   # Split clients into training and test sets.
-  rng = np.random.RandomState(seed=seed)
-  client_ids = list(rng.permutation(client_ids))
+  rng = np.random.default_rng(seed)
+  client_ids = rng.permutation(np.asarray(client_ids)).tolist()
   client_ids_train = client_ids[:NUM_CLIENTS_P13N_TRAIN]
   client_ids_test = client_ids[NUM_CLIENTS_P13N_TRAIN:]
 
@@ -307,15 +559,19 @@ def get_federated_p13n_datasets(
     # Explicit placement on the CPU avoids a known TF issue:
     # https://github.com/tensorflow/tensorflow/issues/34112.
     # with tf.device('/CPU:0'):
-    client_dataset_train = emnist_train.dataset_computation(client_id)
-    client_dataset_test = emnist_test.dataset_computation(client_id)
+    client_dataset_train = emnist_train.serializable_dataset_fn(client_id)
+    client_dataset_test = emnist_test.serializable_dataset_fn(client_id)
     client_dataset_full = client_dataset_train.concatenate(client_dataset_test)
+    if cache_dir is not None:
+      client_dataset_full = _cache_to_file(
+          client_dataset_full,
+          tf.strings.join([p13n_cache_dir, client_id], separator='/'))
     return train_preprocess_fn(client_dataset_full)
 
   @tff.tf_computation(tf.string)
   def build_eval_dataset_from_client_id(client_id):
-    client_dataset_train = emnist_train.dataset_computation(client_id)
-    client_dataset_test = emnist_test.dataset_computation(client_id)
+    client_dataset_train = emnist_train.serializable_dataset_fn(client_id)
+    client_dataset_test = emnist_test.serializable_dataset_fn(client_id)
     return collections.OrderedDict([
       ('train_data', eval_inner_preprocess_fn(client_dataset_train)),
       ('test_data', eval_outer_preprocess_fn(client_dataset_test)),
@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import collections
+import os
 from unittest import mock
 
+import numpy as np
 import tensorflow as tf
 import tensorflow_federated as tff
 
@@ -30,6 +32,16 @@ TEST_DATA = collections.OrderedDict(
 )
 
 
+def _get_dataset_op_types(dataset):
+  """Returns the types of the ops in the graph of a `tf.data.Dataset`."""
+  graph_def = tf.compat.v1.GraphDef.FromString(
+      dataset._as_serialized_graph().numpy())
+  op_types = [node.op for node in graph_def.node]
+  for function in graph_def.library.function:
+    op_types.extend(node.op for node in function.node_def)
+  return op_types
+
+
 class DigitRecognitionPreprocessFnTest(tf.test.TestCase):
 
   def test_preprocess_element_spec(self):
@@ -44,6 +56,21 @@ class DigitRecognitionPreprocessFnTest(tf.test.TestCase):
                      (tf.TensorSpec(shape=(None, 28, 28, 1), dtype=tf.float32),
                       tf.TensorSpec(shape=(None,), dtype=tf.int32)))
 
+  def test_preprocess_sets_dataset_options(self):
+    ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=1,
+        batch_size=20,
+        shuffle_buffer_size=1,
+        emnist_task='digit_recognition')
+    preprocessed_ds = preprocess_fn(ds)
+
+    # The options are kept by the dataset returned from the `tff.Computation`.
+    options = preprocessed_ds.options()
+    self.assertTrue(options.autotune.enabled)
+    self.assertTrue(options.experimental_optimization.map_and_batch_fusion)
+    self.assertTrue(options.experimental_optimization.noop_elimination)
+
   def test_preprocess_returns_correct_element(self):
     ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
     preprocess_fn = emnist_dataset.create_preprocess_fn(
@@ -58,6 +85,131 @@ class DigitRecognitionPreprocessFnTest(tf.test.TestCase):
                         tf.zeros(shape=(1,), dtype=tf.int32))
     self.assertAllClose(self.evaluate(element), expected_element)
 
+  def test_preprocess_with_cache_returns_correct_element(self):
+    ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=1,
+        batch_size=20,
+        shuffle_buffer_size=1,
+        emnist_task='digit_recognition',
+        cache_dataset=True)
+    preprocessed_ds = preprocess_fn(ds)
+
+    expected_element = (tf.zeros(shape=(1, 28, 28, 1), dtype=tf.float32),
+                        tf.zeros(shape=(1,), dtype=tf.int32))
+    # Iterate twice to ensure the cached dataset can be re-read.
+    for _ in range(2):
+      element = next(iter(preprocessed_ds))
+      self.assertAllClose(self.evaluate(element), expected_element)
+
+  def test_preprocess_with_cache_preserves_pixel_values(self):
+    pixel_value = 3.0 / 255.0
+    ds = tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=[tf.constant(0, dtype=tf.int32)],
+            pixels=[tf.fill((28, 28), pixel_value)]))
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=1,
+        batch_size=20,
+        shuffle_buffer_size=10,
+        emnist_task='digit_recognition',
+        cache_dataset=True)
+    preprocessed_ds = preprocess_fn(ds)
+    self.assertEqual(preprocessed_ds.element_spec,
+                     (tf.TensorSpec(shape=(None, 28, 28, 1), dtype=tf.float32),
+                      tf.TensorSpec(shape=(None,), dtype=tf.int32)))
+
+    element = next(iter(preprocessed_ds))
+    expected_element = (tf.fill((1, 28, 28, 1), pixel_value),
+                        tf.zeros(shape=(1,), dtype=tf.int32))
+    self.assertAllClose(self.evaluate(element), expected_element)
+
+  def test_preprocess_with_cache_clips_and_rounds_pixel_values(self):
+    # Quantization clips pixels to [0, 1] and rounds them to multiples of 1/255.
+    ds = tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=tf.zeros((3,), dtype=tf.int32),
+            pixels=tf.reshape(
+                tf.repeat([-0.5, 0.501, 1.5], 28 * 28), (3, 28, 28))))
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=1,
+        batch_size=3,
+        shuffle_buffer_size=1,
+        emnist_task='digit_recognition',
+        cache_dataset=True)
+    preprocessed_ds = preprocess_fn(ds)
+
+    x, _ = next(iter(preprocessed_ds))
+    self.assertAllClose(
+        self.evaluate(x)[:, 0, 0, 0], [0.0, 128.0 / 255.0, 1.0])
+
+  def test_preprocess_shuffles_each_epoch_in_memory(self):
+    num_examples = 5
+    ds = tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=tf.range(num_examples, dtype=tf.int32),
+            pixels=tf.zeros((num_examples, 28, 28), dtype=tf.float32)))
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=2,
+        batch_size=num_examples,
+        emnist_task='digit_recognition',
+        in_memory_shuffle=True)
+    preprocessed_ds = preprocess_fn(ds)
+
+    batches = list(preprocessed_ds)
+    self.assertLen(batches, 2)
+    # Each epoch contains every example exactly once.
+    for _, y in batches:
+      self.assertAllEqual(sorted(self.evaluate(y)), range(num_examples))
+
+  def test_preprocess_limits_number_of_batches(self):
+    ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=-1,
+        batch_size=1,
+        max_batches=3,
+        shuffle_buffer_size=1,
+        emnist_task='digit_recognition')
+    preprocessed_ds = preprocess_fn(ds)
+    self.assertLen(list(preprocessed_ds), 3)
+
+  def test_preprocess_with_negative_max_batches_does_not_limit_batches(self):
+    ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=4,
+        batch_size=1,
+        max_batches=-1,
+        shuffle_buffer_size=1,
+        emnist_task='digit_recognition')
+    preprocessed_ds = preprocess_fn(ds)
+    self.assertLen(list(preprocessed_ds), 4)
+
+  def test_preprocess_omits_transformations_without_effect(self):
+    ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    elidable_op_types = ('ShuffleDataset', 'RepeatDataset', 'TakeDataset')
+
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=1,
+        batch_size=20,
+        max_batches=-1,
+        shuffle_buffer_size=1,
+        emnist_task='digit_recognition')
+    op_types = _get_dataset_op_types(preprocess_fn(ds))
+    for elidable_op_type in elidable_op_types:
+      self.assertFalse(
+          any(op_type.startswith(elidable_op_type) for op_type in op_types))
+
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=2,
+        batch_size=20,
+        max_batches=3,
+        shuffle_buffer_size=10,
+        emnist_task='digit_recognition')
+    op_types = _get_dataset_op_types(preprocess_fn(ds))
+    for elidable_op_type in elidable_op_types:
+      self.assertTrue(
+          any(op_type.startswith(elidable_op_type) for op_type in op_types))
+
 
 class AutoencoderPreprocessFnTest(tf.test.TestCase):
 
@@ -90,12 +242,109 @@ class AutoencoderPreprocessFnTest(tf.test.TestCase):
                         tf.ones(shape=(1, 784), dtype=tf.float32))
     self.assertAllClose(self.evaluate(element), expected_element)
 
+  def test_preprocess_with_in_memory_shuffle_handles_empty_dataset(self):
+    ds = tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=tf.zeros((0,), dtype=tf.int32),
+            pixels=tf.zeros((0, 28, 28), dtype=tf.float32)))
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=2,
+        batch_size=20,
+        emnist_task='autoencoder',
+        in_memory_shuffle=True)
+    preprocessed_ds = preprocess_fn(ds)
+    self.assertEmpty(list(preprocessed_ds))
+
+  def test_preprocess_shuffles_each_epoch_in_memory(self):
+    num_examples = 5
+    ds = tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=tf.range(num_examples, dtype=tf.int32),
+            pixels=tf.reshape(
+                tf.repeat(
+                    tf.range(num_examples, dtype=tf.float32) * 0.2, 28 * 28),
+                (num_examples, 28, 28))))
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=2,
+        batch_size=num_examples,
+        emnist_task='autoencoder',
+        in_memory_shuffle=True)
+    preprocessed_ds = preprocess_fn(ds)
+
+    batches = list(preprocessed_ds)
+    self.assertLen(batches, 2)
+    # Each epoch contains every example exactly once.
+    for x, _ in batches:
+      self.assertAllClose(
+          sorted(self.evaluate(x)[:, 0]), [0.2, 0.4, 0.6, 0.8, 1.0])
+
+  def test_preprocess_with_in_memory_shuffle_limits_number_of_batches(self):
+    num_examples = 5
+    ds = tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=tf.range(num_examples, dtype=tf.int32),
+            pixels=tf.zeros((num_examples, 28, 28), dtype=tf.float32)))
+    preprocess_fn = emnist_dataset.create_preprocess_fn(
+        num_epochs=-1,
+        batch_size=2,
+        max_batches=3,
+        emnist_task='autoencoder',
+        in_memory_shuffle=True)
+    preprocessed_ds = preprocess_fn(ds)
+
+    # The epochs are not read in full, so the materialized dataset is repeated
+    # without being cached.
+    self.assertNotIn('CacheDatasetV2', _get_dataset_op_types(preprocessed_ds))
+    for _ in range(2):
+      self.assertLen(list(preprocessed_ds), 3)
+
+  def test_reshape_shares_inputs_and_targets(self):
+    element = collections.OrderedDict(
+        label=tf.zeros((2,), dtype=tf.int32),
+        pixels=tf.zeros((2, 28, 28), dtype=tf.uint8))
+    x, y = emnist_dataset._reshape_for_autoencoder(element)
+    self.assertIs(x, y)
+
+    reshape_fn = tf.function(emnist_dataset._reshape_for_autoencoder)
+    graph = reshape_fn.get_concrete_function(element).graph
+    sub_ops = [op for op in graph.get_operations() if op.type == 'Sub']
+    self.assertLen(sub_ops, 1)
+
+  def test_preprocess_with_small_shuffle_buffer_uses_shuffle_buffer(self):
+    ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    with mock.patch.object(
+        emnist_dataset,
+        '_shuffle_and_repeat_in_memory') as mock_shuffle_in_memory:
+      preprocess_fn = emnist_dataset.create_preprocess_fn(
+          num_epochs=1,
+          batch_size=20,
+          shuffle_buffer_size=10,
+          emnist_task='autoencoder',
+          in_memory_shuffle=True)
+      preprocessed_ds = preprocess_fn(ds)
+
+    # A shuffle buffer smaller than `MAX_CLIENT_DATASET_SIZE` is kept, even
+    # though shuffling in memory is allowed.
+    mock_shuffle_in_memory.assert_not_called()
+    self.assertTrue(
+        any(op_type.startswith('ShuffleDataset')
+            for op_type in _get_dataset_op_types(preprocessed_ds)))
+
+    element = next(iter(preprocessed_ds))
+    expected_element = (tf.ones(shape=(1, 784), dtype=tf.float32),
+                        tf.ones(shape=(1, 784), dtype=tf.float32))
+    self.assertAllClose(self.evaluate(element), expected_element)
+
 
 EMNIST_LOAD_DATA = 'tensorflow_federated.simulation.datasets.emnist.load_data'
 
 
 class FederatedDatasetTest(tf.test.TestCase):
 
+  def setUp(self):
+    super().setUp()
+    emnist_dataset._load_emnist_data.cache_clear()
+
   @mock.patch(EMNIST_LOAD_DATA)
   def test_preprocess_applied(self, mock_load_data):
     if tf.config.list_logical_devices('GPU'):
@@ -119,9 +368,42 @@ class FederatedDatasetTest(tf.test.TestCase):
     self.assertEqual(mock_test.mock_calls,
                      mock.call.preprocess(mock.ANY).call_list())
 
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_load_data_is_memoized(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    mock_train = mock.create_autospec(tff.simulation.datasets.ClientData)
+    mock_test = mock.create_autospec(tff.simulation.datasets.ClientData)
+    mock_load_data.return_value = (mock_train, mock_test)
+
+    _, _ = emnist_dataset.get_federated_datasets()
+    _, _ = emnist_dataset.get_federated_datasets(train_client_batch_size=10)
+
+    mock_load_data.assert_called_once()
+
+
+def _create_centralized_client_dataset(client_id):
+  """Creates a client dataset with one example, labeled by the client id."""
+  return tf.data.Dataset.from_tensors(
+      collections.OrderedDict(
+          label=tf.strings.to_number(client_id, out_type=tf.int32),
+          pixels=tf.zeros((28, 28), dtype=tf.float32)))
+
+
+def _create_mock_centralized_client_data(num_clients=1):
+  """Creates a mock `ClientData` with client ids '0', '1', and so on."""
+  mock_client_data = mock.create_autospec(tff.simulation.datasets.ClientData)
+  mock_client_data.client_ids = [str(i) for i in range(num_clients)]
+  mock_client_data.serializable_dataset_fn = _create_centralized_client_dataset
+  return mock_client_data
+
 
 class CentralizedDatasetTest(tf.test.TestCase):
 
+  def setUp(self):
+    super().setUp()
+    emnist_dataset._load_emnist_data.cache_clear()
+
   @mock.patch(EMNIST_LOAD_DATA)
   def test_preprocess_applied(self, mock_load_data):
     if tf.config.list_logical_devices('GPU'):
@@ -131,28 +413,196 @@ class CentralizedDatasetTest(tf.test.TestCase):
     # objects we desired are used.
     #
     # The correctness of the preprocessing function is tested in other tests.
-    sample_ds = tf.data.Dataset.from_tensor_slices(TEST_DATA)
+    mock_train = _create_mock_centralized_client_data(num_clients=3)
+    mock_test = _create_mock_centralized_client_data(num_clients=3)
+    mock_load_data.return_value = (mock_train, mock_test)
 
-    mock_train = mock.create_autospec(tff.simulation.datasets.ClientData)
-    mock_train.create_tf_dataset_from_all_clients = mock.Mock(
-        return_value=sample_ds)
+    train_ds, test_ds = emnist_dataset.get_centralized_datasets()
 
-    mock_test = mock.create_autospec(tff.simulation.datasets.ClientData)
-    mock_test.create_tf_dataset_from_all_clients = mock.Mock(
-        return_value=sample_ds)
+    mock_load_data.assert_called_once()
+
+    # Assert the train and test are amalgamated into single datasets over all
+    # clients by reading the client datasets directly, rather than through
+    # other `ClientData` methods.
+    self.assertEmpty(mock_train.mock_calls)
+    self.assertEmpty(mock_test.mock_calls)
+
+    # The client datasets are interleaved in a non-deterministic order, but
+    # the example of every client is in the amalgamated datasets.
+    for ds in [train_ds, test_ds]:
+      labels = np.concatenate([self.evaluate(y) for _, y in ds])
+      self.assertCountEqual(labels, [0, 1, 2])
+
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_datasets_cached_in_memory_by_default(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    mock_load_data.return_value = (_create_mock_centralized_client_data(),
+                                   _create_mock_centralized_client_data())
 
+    for cache_dataset in [True, False]:
+      train_ds, test_ds = emnist_dataset.get_centralized_datasets(
+          cache_dataset=cache_dataset)
+      for ds in [train_ds, test_ds]:
+        self.assertEqual(
+            'CacheDatasetV2' in _get_dataset_op_types(ds), cache_dataset)
+        self.assertLen(list(ds), 1)
+
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_datasets_cached_to_cache_dir(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    mock_train = _create_mock_centralized_client_data()
+    mock_test = _create_mock_centralized_client_data()
     mock_load_data.return_value = (mock_train, mock_test)
 
-    _, _ = emnist_dataset.get_centralized_datasets()
+    cache_dir = self.get_temp_dir()
+    train_ds, test_ds = emnist_dataset.get_centralized_datasets(
+        cache_dir=cache_dir)
+    # Iterate twice, so that the second pass reads from the cache.
+    for _ in range(2):
+      self.assertLen(list(train_ds), 1)
+      self.assertLen(list(test_ds), 1)
 
-    mock_load_data.assert_called_once()
+    cache_files = tf.io.gfile.listdir(os.path.join(cache_dir, 'emnist_all'))
+    self.assertTrue(any(f.startswith('train') for f in cache_files))
+    self.assertTrue(any(f.startswith('test') for f in cache_files))
 
-    # Assert the validation ClientData isn't used, and the train and test
-    # are amalgamated into datasets single datasets over all clients.
-    self.assertEqual(mock_train.mock_calls,
-                     mock.call.create_tf_dataset_from_all_clients().call_list())
-    self.assertEqual(mock_test.mock_calls,
-                     mock.call.create_tf_dataset_from_all_clients().call_list())
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_datasets_with_cache_dir_use_shuffle_buffer(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    mock_train = _create_mock_centralized_client_data()
+    mock_test = _create_mock_centralized_client_data()
+    mock_load_data.return_value = (mock_train, mock_test)
+
+    with mock.patch.object(
+        emnist_dataset, '_shuffle_and_repeat_in_memory'
+    ) as mock_shuffle_in_memory, mock.patch.object(
+        tf.data.Dataset,
+        'shuffle',
+        autospec=True,
+        side_effect=tf.data.Dataset.shuffle) as mock_shuffle:
+      train_ds, _ = emnist_dataset.get_centralized_datasets(
+          train_shuffle_buffer_size=10000, cache_dir=self.get_temp_dir())
+
+    # The centralized datasets are never materialized in memory, even though
+    # the train shuffle buffer is larger than `MAX_CLIENT_DATASET_SIZE`.
+    mock_shuffle_in_memory.assert_not_called()
+    mock_shuffle.assert_called_once_with(mock.ANY, 10000)
+    self.assertLen(list(train_ds), 1)
+
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_datasets_prefetched_to_device(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    mock_train = _create_mock_centralized_client_data()
+    mock_test = _create_mock_centralized_client_data()
+    mock_load_data.return_value = (mock_train, mock_test)
+
+    train_ds, test_ds = emnist_dataset.get_centralized_datasets(
+        device='/CPU:0')
+
+    expected_element_spec = (
+        tf.TensorSpec(shape=(None, 28, 28, 1), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.int32))
+    for ds in [train_ds, test_ds]:
+      self.assertEqual(ds.element_spec, expected_element_spec)
+      self.assertLen(list(ds), 1)
+
+
+def _create_p13n_client_dataset_fn(labels):
+  """Returns a function creating client datasets with the given labels."""
+
+  def create_client_dataset(client_id):
+    del client_id  # Unused.
+    return tf.data.Dataset.from_tensor_slices(
+        collections.OrderedDict(
+            label=np.array(labels, dtype=np.int32),
+            pixels=np.zeros((len(labels), 28, 28), dtype=np.float32)))
+
+  return create_client_dataset
+
+
+def _create_mock_p13n_client_data(client_ids, labels):
+  mock_client_data = mock.create_autospec(tff.simulation.datasets.ClientData)
+  mock_client_data.client_ids = client_ids
+  mock_client_data.serializable_dataset_fn = _create_p13n_client_dataset_fn(
+      labels)
+  return mock_client_data
+
+
+class FederatedP13nDatasetTest(tf.test.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    emnist_dataset._load_emnist_data.cache_clear()
+
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_train_datasets_cached_to_cache_dir(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    client_ids = ['client_0', 'client_1']
+    mock_load_data.return_value = (
+        _create_mock_p13n_client_data(client_ids, labels=[0, 1]),
+        _create_mock_p13n_client_data(client_ids, labels=[2, 3]))
+
+    cache_dir = self.get_temp_dir()
+    client_ids_train, _, build_train_dataset_from_client_id, _ = (
+        emnist_dataset.get_federated_p13n_datasets(
+            shuffle_buffer_size=1, cache_dir=cache_dir))
+    self.assertCountEqual(client_ids_train, client_ids)
+
+    train_ds = build_train_dataset_from_client_id('client_0')
+    # Iterate twice, so that the second pass reads from the cache.
+    first_pass = [self.evaluate(y) for _, y in train_ds]
+    second_pass = [self.evaluate(y) for _, y in train_ds]
+    self.assertAllEqual(np.concatenate(first_pass), [0, 1, 2, 3])
+    self.assertAllEqual(np.concatenate(second_pass), [0, 1, 2, 3])
+
+    cache_files = tf.io.gfile.listdir(
+        os.path.join(cache_dir, 'emnist_all', 'p13n'))
+    self.assertTrue(any(f.startswith('client_0') for f in cache_files))
+    self.assertFalse(any(f.startswith('client_1') for f in cache_files))
+
+  @mock.patch(EMNIST_LOAD_DATA)
+  def test_datasets_split_and_preprocessed(self, mock_load_data):
+    if tf.config.list_logical_devices('GPU'):
+      self.skipTest('skip GPU test')
+    client_ids = ['client_{}'.format(i) for i in range(TOTAL_NUM_CLIENTS)]
+    mock_load_data.return_value = (
+        _create_mock_p13n_client_data(client_ids, labels=[0, 1]),
+        _create_mock_p13n_client_data(client_ids, labels=[2, 3]))
+
+    with mock.patch.object(os, 'cpu_count', return_value=64), \
+        mock.patch.object(
+            emnist_dataset,
+            'create_preprocess_fn',
+            wraps=emnist_dataset.create_preprocess_fn) as mock_preprocess_fn:
+      (client_ids_train, client_ids_test, build_train_dataset_from_client_id,
+       build_eval_dataset_from_client_id) = (
+           emnist_dataset.get_federated_p13n_datasets(seed=0))
+
+    self.assertLen(client_ids_train, emnist_dataset.NUM_CLIENTS_P13N_TRAIN)
+    self.assertLen(client_ids_test,
+                   TOTAL_NUM_CLIENTS - emnist_dataset.NUM_CLIENTS_P13N_TRAIN)
+    self.assertCountEqual(client_ids_train + client_ids_test, client_ids)
+
+    # By default, map parallelism is capped at 16 for p13n client datasets.
+    self.assertLen(mock_preprocess_fn.call_args_list, 3)
+    for call in mock_preprocess_fn.call_args_list:
+      self.assertEqual(call[1]['num_parallel_calls'], 16)
+
+    expected_element_spec = (
+        tf.TensorSpec(shape=(None, 28, 28, 1), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.int32))
+    train_ds = build_train_dataset_from_client_id(client_ids_train[0])
+    self.assertEqual(train_ds.element_spec, expected_element_spec)
+    eval_datasets = build_eval_dataset_from_client_id(client_ids_test[0])
+    self.assertEqual(eval_datasets['train_data'].element_spec,
+                     expected_element_spec)
+    self.assertEqual(eval_datasets['test_data'].element_spec,
+                     expected_element_spec)
 
 
 if __name__ == '__main__':